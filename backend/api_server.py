@@ -1,26 +1,57 @@
-from flask import Flask, request, jsonify, Response, stream_with_context
+from flask import Flask, Request, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 import json
-import base64
 import os
 import time
-from io import BytesIO
+import tempfile
+import threading
 from dotenv import load_dotenv
-from utils import InvoiceData, GroqClient, process_file_upload, process_image_url
+from utils import (
+    InvoiceData, GroqClient, process_image_url, prepare_upload,
+    validate_invoice_arithmetic, get_flagged_fields, get_field_value, apply_field_corrections, clean_field_corrections,
+    build_extraction_prompt, score_pdf_pages
+)
 from excel_handler import ExcelDatabase
 
-app = Flask(__name__)
-CORS(app)  # Enable CORS for Next.js frontend
-
 # Load environment variables
 load_dotenv()
 groq_api_key = os.getenv("GROQ_API_KEY")
 
+# Upload limits: requests above MAX_UPLOAD_SIZE_MB are rejected before the body is read,
+# uploaded files above UPLOAD_SPOOL_THRESHOLD_KB are spooled to a temporary file
+MAX_UPLOAD_SIZE_MB = int(os.getenv("MAX_UPLOAD_SIZE_MB", 25))
+UPLOAD_SPOOL_THRESHOLD_KB = int(os.getenv("UPLOAD_SPOOL_THRESHOLD_KB", 512))
+
+class SpooledUploadRequest(Request):
+    """Request that keeps small uploads in memory and spools larger ones to disk"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_THRESHOLD_KB * 1024, mode="rb+")
+
+app = Flask(__name__)
+app.request_class = SpooledUploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+CORS(app)  # Enable CORS for Next.js frontend
+
 if not groq_api_key:
     print("WARNING: GROQ_API_KEY not found in environment variables!")
 
-# Initialize Excel database
-excel_db = ExcelDatabase()
+# Excel database is created on first use, not at import time, to keep cold starts fast
+_excel_db = None
+_excel_db_lock = threading.Lock()
+
+def get_excel_db() -> ExcelDatabase:
+    """Return the shared Excel database, initializing it on first use"""
+    global _excel_db
+    if _excel_db is None:
+        with _excel_db_lock:
+            if _excel_db is None:
+                _excel_db = ExcelDatabase()
+    return _excel_db
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"Upload too large. Maximum upload size is {MAX_UPLOAD_SIZE_MB} MB"}), 413
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
@@ -45,6 +76,16 @@ def extract_invoice():
         mime_type = "image/jpeg"
         image_content = None
         
+        # Text layer handling for digital PDFs:
+        #   'auto'      - use the text layer instead of OCR, send a low-resolution image for layout
+        #   'text_only' - use the text layer instead of OCR, skip rasterization entirely
+        #   'off'       - always rasterize at full resolution and OCR the page
+        text_layer_mode = data.get('text_layer_mode', 'auto')
+        if text_layer_mode not in ('auto', 'text_only', 'off'):
+            return jsonify({"error": "Invalid text_layer_mode. Use 'auto', 'text_only' or 'off'"}), 400
+        text_layer = None
+        page_number = None
+        
         if input_method == 'upload':
             # Handle file upload
             if 'file' not in request.files:
@@ -56,17 +97,18 @@ def extract_invoice():
             if file.filename == '':
                 return jsonify({"error": "No file selected"}), 400
             
-            # Get page number, default to 0
-            try:
-                page_number = int(request.form.get('page_number', 0))
-            except (ValueError, TypeError):
-                page_number = 0
+            # Get page number, default to 0. 'auto' picks the most likely invoice page of a PDF
+            if str(request.form.get('page_number', '')).lower() == 'auto':
+                page_number = 'auto'
+            else:
+                try:
+                    page_number = int(request.form.get('page_number', 0))
+                except (ValueError, TypeError):
+                    page_number = 0
             
-            # Process the file
+            # Page detection, text layer, rasterization and encoding (shared with the async server)
             try:
-                # Reset file pointer in case it was read before
-                file.seek(0)
-                image_bytes, mime_type, total_pages = process_file_upload(file, page_number)
+                page_number, text_layer, image_content = prepare_upload(file, page_number, text_layer_mode)
             except Exception as e:
                 import traceback
                 error_details = traceback.format_exc()
@@ -74,108 +116,6 @@ def extract_invoice():
                 print(f"Traceback: {error_details}")
                 return jsonify({"error": f"Failed to process file: {str(e)}"}), 400
             
-            if not image_bytes:
-                return jsonify({"error": "Failed to process file: No image data generated"}), 400
-            
-            # Validate image bytes - just check if we have data
-            if len(image_bytes) == 0:
-                return jsonify({"error": "Invalid image: Empty image data"}), 400
-            
-            # Basic validation - check if bytes look like an image (have minimum size)
-            if len(image_bytes) < 100:  # Images should be at least 100 bytes
-                return jsonify({"error": "Invalid image: File too small to be a valid image"}), 400
-            
-            # Ensure image is in JPEG format for Groq API compatibility
-            # Check if bytes are already JPEG (from PDF conversion or already processed)
-            is_already_jpeg = len(image_bytes) >= 2 and image_bytes[:2] == b'\xff\xd8'
-            
-            if not is_already_jpeg:
-                # Need to convert to JPEG
-                try:
-                    from PIL import Image
-                    
-                    # Create a fresh BytesIO object from the image bytes
-                    img_stream = BytesIO(image_bytes)
-                    img = Image.open(img_stream)
-                    img.load()  # Force load to ensure it's readable
-                    
-                    # Convert to RGB if necessary
-                    if img.mode != 'RGB':
-                        if img.mode == 'RGBA':
-                            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                            if len(img.split()) >= 4:
-                                rgb_img.paste(img, mask=img.split()[3])  # Use alpha channel as mask
-                            else:
-                                rgb_img.paste(img)
-                            img.close()
-                            img = rgb_img
-                        elif img.mode == 'P':
-                            img = img.convert('RGBA')
-                            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-                            if len(img.split()) >= 4:
-                                rgb_img.paste(img, mask=img.split()[3])
-                            else:
-                                rgb_img.paste(img)
-                            img.close()
-                            img = rgb_img
-                        else:
-                            img = img.convert('RGB')
-                    
-                    # Resize if image is too large (Groq has size limits)
-                    max_size = 4096  # Maximum dimension
-                    if img.width > max_size or img.height > max_size:
-                        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-                    
-                    # Save as JPEG to ensure compatibility
-                    output = BytesIO()
-                    img.save(output, format='JPEG', quality=90, optimize=True)
-                    image_bytes = output.getvalue()
-                    mime_type = "image/jpeg"
-                    
-                    # Validate the JPEG bytes
-                    if len(image_bytes) < 100:
-                        raise ValueError("Converted image is too small")
-                    
-                    # Verify it's a valid JPEG by checking magic bytes
-                    if image_bytes[:2] != b'\xff\xd8':
-                        raise ValueError("Image is not a valid JPEG after conversion")
-                    
-                    img.close()
-                    output.close()
-                    img_stream.close()
-                except Exception as e:
-                    return jsonify({"error": f"Failed to process image: {str(e)}"}), 400
-            else:
-                # Already JPEG, just ensure mime_type is set correctly
-                mime_type = "image/jpeg"
-            
-            # Convert to base64
-            try:
-                base64_image = base64.b64encode(image_bytes).decode("utf-8")
-                if not base64_image:
-                    return jsonify({"error": "Failed to encode image to base64"}), 400
-                
-                # Validate base64 string
-                if len(base64_image) < 100:
-                    return jsonify({"error": "Base64 encoded image too small"}), 400
-                
-                # Check base64 is valid (basic check)
-                try:
-                    base64.b64decode(base64_image, validate=True)
-                except Exception:
-                    return jsonify({"error": "Invalid base64 encoding"}), 400
-            except Exception as e:
-                return jsonify({"error": f"Failed to encode image: {str(e)}"}), 400
-            
-            # Create data URL - ensure mime type is image/jpeg for Groq compatibility
-            # Groq expects: data:image/jpeg;base64,{base64_string}
-            data_url = f"data:image/jpeg;base64,{base64_image}"
-            
-            image_content = {
-                "type": "image_url",
-                "image_url": {"url": data_url}
-            }
-            
         elif input_method == 'url':
             # Handle image URL
             image_url = data.get('image_url')
@@ -195,16 +135,17 @@ def extract_invoice():
         # Extract invoice data with progress tracking
         groq_client = GroqClient(api_key=groq_api_key)
         
-        # First, extract raw OCR text
-        raw_ocr_text = groq_client.extract_raw_text(image_content)
+        if text_layer is not None:
+            # Digital PDF: the embedded text layer replaces the OCR call
+            raw_ocr_text = text_layer
+            text_source = "text_layer"
+        else:
+            # First, extract raw OCR text
+            raw_ocr_text = groq_client.extract_raw_text(image_content)
+            text_source = "ocr"
         
         # Then, extract structured data
-        prompt = f"""
-        You are an intelligent OCR extraction agent capable of understanding and processing documents in multiple languages.
-        Given an image of an invoice (which may have been converted from a PDF), extract all relevant information in structured JSON format.
-        The JSON object must use the schema: {json.dumps(InvoiceData.model_json_schema(), indent=2)}
-        If any field cannot be found in the invoice, return it as null. Return the final result strictly in JSON format.
-        """
+        prompt = build_extraction_prompt(text_layer, has_image=image_content is not None)
         
         extracted_data, raw_json_response = groq_client.extract_invoice_data(prompt, image_content)
         invoice = InvoiceData(**extracted_data)
@@ -213,15 +154,98 @@ def extract_invoice():
             "success": True,
             "data": invoice.dict(),
             "raw_ocr_text": raw_ocr_text,
-            "raw_json_response": raw_json_response
+            "raw_json_response": raw_json_response,
+            "text_source": text_source,
+            "page_number": page_number,
+            "validation_issues": validate_invoice_arithmetic(invoice)
         })
     
+    except HTTPException:
+        raise  # Let HTTP errors (e.g. 413 for oversized uploads, raised when the body is first read) reach their handlers
     except Exception as e:
         return jsonify({"error": f"Failed to parse invoice: {str(e)}"}), 500
 
+# Completion token budget for /api/reextract-fields, sized from the number of flagged fields
+REEXTRACT_BASE_TOKENS = 64
+REEXTRACT_TOKENS_PER_FIELD = 32
+REEXTRACT_MAX_TOKENS = 2048
+
+@app.route('/api/reextract-fields', methods=['POST'])
+def reextract_fields():
+    """Re-query the model for only the fields that failed arithmetic validation"""
+    try:
+        if not groq_api_key:
+            return jsonify({"error": "GROQ_API_KEY not configured"}), 500
+        
+        data = request.json
+        if not data or 'data' not in data:
+            return jsonify({"error": "Invoice data required"}), 400
+        
+        raw_ocr_text = data.get('raw_ocr_text')
+        image_url = data.get('image_url')
+        if not raw_ocr_text and not image_url:
+            return jsonify({"error": "raw_ocr_text or image_url required"}), 400
+        
+        invoice = InvoiceData(**data['data'])
+        issues = validate_invoice_arithmetic(invoice)
+        if not issues:
+            return jsonify({
+                "success": True,
+                "data": invoice.dict(),
+                "validation_issues": [],
+                "corrected_fields": {},
+                "dropped_fields": []
+            })
+        
+        invoice_data = invoice.dict()
+        fields = get_flagged_fields(issues)
+        current_values = {field: get_field_value(invoice_data, field) for field in fields}
+        problems = "\n".join(f"- {issue['message']}" for issue in issues)
+        
+        # Small focused prompt: only the flagged fields and the source text
+        prompt = f"""
+        Some numeric fields extracted from an invoice failed arithmetic checks:
+        {problems}
+        Current values: {json.dumps(current_values)}
+        Re-read these fields from the invoice and return a JSON object with exactly these keys: {json.dumps(fields)}
+        Each value must be the number as printed on the invoice, or null if it is not present.
+        """
+        if raw_ocr_text:
+            prompt += f"""
+        Invoice text:
+        {raw_ocr_text}
+        """
+        
+        image_content = {"type": "image_url", "image_url": {"url": image_url}} if image_url else None
+        
+        groq_client = GroqClient(api_key=groq_api_key)
+        # Budget ~32 tokens per '"line_items[12].unit_price": 12.5' entry so the JSON isn't cut off
+        max_completion_tokens = min(REEXTRACT_BASE_TOKENS + REEXTRACT_TOKENS_PER_FIELD * len(fields), REEXTRACT_MAX_TOKENS)
+        corrections, raw_json_response = groq_client.extract_invoice_data(
+            prompt, image_content, max_completion_tokens=max_completion_tokens
+        )
+        # Drop values that aren't numbers instead of failing the whole request
+        corrections, dropped_fields = clean_field_corrections(corrections, fields)
+        
+        corrected_invoice = InvoiceData(**apply_field_corrections(invoice_data, corrections))
+        
+        return jsonify({
+            "success": True,
+            "data": corrected_invoice.dict(),
+            "validation_issues": validate_invoice_arithmetic(corrected_invoice),
+            "corrected_fields": corrections,
+            "dropped_fields": dropped_fields,
+            "raw_json_response": raw_json_response
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        return jsonify({"error": f"Failed to re-extract fields: {str(e)}"}), 500
+
 @app.route('/api/pdf-info', methods=['POST'])
 def get_pdf_info():
-    """Get PDF page count for page selection"""
+    """Get PDF page count and per-page invoice likelihood scores for page selection"""
     try:
         if 'file' not in request.files:
             return jsonify({"error": "No file provided"}), 400
@@ -229,15 +253,27 @@ def get_pdf_info():
         file = request.files['file']
         from pypdf import PdfReader
         
-        pdf_bytes = file.read()
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
+        pdf_reader = PdfReader(file.stream)
         total_pages = len(pdf_reader.pages)
         
-        return jsonify({
+        result = {
             "success": True,
             "total_pages": total_pages
-        })
+        }
+        
+        # Page scoring is opt-in; a scoring failure still returns the page count
+        if request.form.get('score_pages', 'false').lower() == 'true':
+            try:
+                page_scores = score_pdf_pages(file)
+                result["page_scores"] = page_scores
+                result["likely_invoice_pages"] = [page_score['page'] for page_score in page_scores if page_score['likely_invoice']]
+            except Exception as e:
+                result["page_scores_error"] = f"Failed to score pages: {str(e)}"
+        
+        return jsonify(result)
     
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({"error": f"Failed to read PDF: {str(e)}"}), 500
 
@@ -266,11 +302,13 @@ def save_invoice():
         # Sanitize data to remove NaN values
         sanitized_data = sanitize_data(data)
         
-        result = excel_db.save_invoice(sanitized_data)
+        result = get_excel_db().save_invoice(sanitized_data)
         if result['success']:
             return jsonify(result), 200
         else:
             return jsonify(result), 400
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({"error": f"Failed to save invoice: {str(e)}"}), 500
 
@@ -285,11 +323,13 @@ def update_invoice():
         order_id = data['order_id']
         invoice_data = {k: v for k, v in data.items() if k != 'order_id'}
         
-        result = excel_db.update_invoice(order_id, invoice_data)
+        result = get_excel_db().update_invoice(order_id, invoice_data)
         if result['success']:
             return jsonify(result), 200
         else:
             return jsonify(result), 400
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({"error": f"Failed to update invoice: {str(e)}"}), 500
 
@@ -297,7 +337,7 @@ def update_invoice():
 def get_invoices():
     """Get all invoices from database"""
     try:
-        result = excel_db.get_all_invoices()
+        result = get_excel_db().get_all_invoices()
         return jsonify(result), 200
     except Exception as e:
         return jsonify({"error": f"Failed to get invoices: {str(e)}"}), 500
@@ -306,7 +346,7 @@ def get_invoices():
 def get_invoice(order_id):
     """Get specific invoice by OrderID"""
     try:
-        result = excel_db.get_invoice_by_id(order_id)
+        result = get_excel_db().get_invoice_by_id(order_id)
         if result['success']:
             return jsonify(result), 200
         else:
@@ -314,5 +354,66 @@ def get_invoice(order_id):
     except Exception as e:
         return jsonify({"error": f"Failed to get invoice: {str(e)}"}), 500
 
+@app.route('/api/summary', methods=['GET'])
+def get_summary():
+    """Get invoice totals grouped by vendor, currency, month and/or status"""
+    try:
+        group_by = request.args.get('group_by')
+        group_by = [dimension.strip() for dimension in group_by.split(',') if dimension.strip()] if group_by else None
+        
+        result = get_excel_db().get_summary(group_by)
+        if result['success']:
+            return jsonify(result), 200
+        else:
+            return jsonify(result), 400
+    except Exception as e:
+        return jsonify({"error": f"Failed to get summary: {str(e)}"}), 500
+
+@app.route('/api/summary/rebuild', methods=['POST'])
+def rebuild_summary():
+    """Recompute summary aggregates from the Excel database"""
+    try:
+        result = get_excel_db().rebuild_summary()
+        if result['success']:
+            return jsonify(result), 200
+        else:
+            return jsonify(result), 500
+    except Exception as e:
+        return jsonify({"error": f"Failed to rebuild summary: {str(e)}"}), 500
+
+@app.route('/api/search', methods=['GET'])
+def search_invoices():
+    """Full-text search over stored invoices, returning ranked and paginated OrderIDs"""
+    try:
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({"error": "Search query 'q' required"}), 400
+        
+        try:
+            page = max(int(request.args.get('page', 1)), 1)
+            page_size = min(max(int(request.args.get('page_size', 20)), 1), 100)
+        except (ValueError, TypeError):
+            return jsonify({"error": "page and page_size must be integers"}), 400
+        
+        result = get_excel_db().search_invoices(query, page, page_size)
+        if result['success']:
+            return jsonify(result), 200
+        else:
+            return jsonify(result), 500
+    except Exception as e:
+        return jsonify({"error": f"Failed to search invoices: {str(e)}"}), 500
+
+@app.route('/api/search/rebuild', methods=['POST'])
+def rebuild_search_index():
+    """Re-index all invoices in the Excel database"""
+    try:
+        result = get_excel_db().rebuild_search_index()
+        if result['success']:
+            return jsonify(result), 200
+        else:
+            return jsonify(result), 500
+    except Exception as e:
+        return jsonify({"error": f"Failed to rebuild search index: {str(e)}"}), 500
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,173 @@
+"""
+Async (ASGI) variant of the extraction API.
+
+The Flask server in api_server.py blocks a worker thread for the whole duration of the
+two Groq calls made by /api/extract. This server awaits them instead, so a single process
+can keep hundreds of extractions in flight. CPU-bound work (text layer parsing,
+rasterization, JPEG conversion, base64 encoding) runs in a thread pool so it never blocks
+the event loop.
+
+Run with:
+    hypercorn async_api_server:app --bind 0.0.0.0:5001
+"""
+import os
+import asyncio
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from quart import Quart, request, jsonify
+from quart_cors import cors
+from werkzeug.exceptions import HTTPException
+from utils import (
+    InvoiceData, AsyncGroqClient, prepare_upload, build_extraction_prompt,
+    validate_invoice_arithmetic, IMAGE_URL_TIMEOUT
+)
+
+# Load environment variables
+load_dotenv()
+groq_api_key = os.getenv("GROQ_API_KEY")
+
+if not groq_api_key:
+    print("WARNING: GROQ_API_KEY not found in environment variables!")
+
+MAX_UPLOAD_SIZE_MB = int(os.getenv("MAX_UPLOAD_SIZE_MB", 25))
+# Threads available for CPU-bound preprocessing (rasterization itself is also capped
+# by MAX_CONCURRENT_RASTERIZATIONS in utils)
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", os.cpu_count() or 2))
+
+app = Quart(__name__)
+app = cors(app)  # Enable CORS for Next.js frontend
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+
+_cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="extract-cpu")
+
+# One client per process so HTTP connections to Groq are pooled across requests
+groq_client = None
+# Shared client for checking image URLs
+http_client = None
+
+@app.before_serving
+async def startup():
+    global groq_client, http_client
+    if groq_api_key:
+        groq_client = AsyncGroqClient(api_key=groq_api_key)
+    http_client = httpx.AsyncClient(timeout=IMAGE_URL_TIMEOUT, follow_redirects=True)
+
+@app.after_serving
+async def shutdown():
+    if groq_client is not None:
+        await groq_client.close()
+    await http_client.aclose()
+    _cpu_executor.shutdown(wait=False)
+
+async def run_cpu_bound(func, *args):
+    """Run a blocking function in the CPU thread pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_cpu_executor, func, *args)
+
+async def check_image_url(image_url):
+    """Make sure an image URL is reachable without blocking the event loop or a CPU worker"""
+    try:
+        async with http_client.stream('GET', image_url) as response:
+            response.raise_for_status()
+    except Exception as e:
+        raise ValueError(f"Error loading image from URL: {str(e)}")
+
+@app.errorhandler(413)
+async def upload_too_large(e):
+    return jsonify({"error": f"Upload too large. Maximum upload size is {MAX_UPLOAD_SIZE_MB} MB"}), 413
+
+@app.route('/api/health', methods=['GET'])
+async def health_check():
+    return jsonify({"status": "ok", "api_key_configured": bool(groq_api_key)})
+
+@app.route('/api/extract', methods=['POST'])
+async def extract_invoice():
+    try:
+        if groq_client is None:
+            return jsonify({"error": "GROQ_API_KEY not configured"}), 500
+
+        # Get input method - check if it's JSON or form data
+        if request.is_json:
+            data = await request.get_json()
+            input_method = data.get('input_method', 'url')
+        else:
+            # Form data (file upload)
+            data = await request.form
+            input_method = data.get('input_method', 'upload')
+
+        text_layer_mode = data.get('text_layer_mode', 'auto')
+        if text_layer_mode not in ('auto', 'text_only', 'off'):
+            return jsonify({"error": "Invalid text_layer_mode. Use 'auto', 'text_only' or 'off'"}), 400
+
+        if input_method == 'upload':
+            files = await request.files
+            if 'file' not in files:
+                return jsonify({"error": "No file provided"}), 400
+
+            file = files['file']
+            if file.filename == '':
+                return jsonify({"error": "No file selected"}), 400
+
+            # Get page number, default to 0. 'auto' picks the most likely invoice page of a PDF
+            if str(data.get('page_number', '')).lower() == 'auto':
+                page_number = 'auto'
+            else:
+                try:
+                    page_number = int(data.get('page_number', 0))
+                except (ValueError, TypeError):
+                    page_number = 0
+
+            try:
+                page_number, text_layer, image_content = await run_cpu_bound(
+                    prepare_upload, file, page_number, text_layer_mode
+                )
+            except Exception as e:
+                return jsonify({"error": f"Failed to process file: {str(e)}"}), 400
+
+        elif input_method == 'url':
+            image_url = data.get('image_url')
+            if not image_url:
+                return jsonify({"error": "No image URL provided"}), 400
+
+            # Make sure the URL is reachable before spending model calls on it
+            await check_image_url(image_url)
+
+            text_layer = None
+            page_number = None
+            image_content = {
+                "type": "image_url",
+                "image_url": {"url": image_url}
+            }
+        else:
+            return jsonify({"error": "Invalid input_method. Use 'upload' or 'url'"}), 400
+
+        if text_layer is not None:
+            # Digital PDF: the embedded text layer replaces the OCR call
+            raw_ocr_text = text_layer
+            text_source = "text_layer"
+        else:
+            raw_ocr_text = await groq_client.extract_raw_text(image_content)
+            text_source = "ocr"
+
+        prompt = build_extraction_prompt(text_layer, has_image=image_content is not None)
+        extracted_data, raw_json_response = await groq_client.extract_invoice_data(prompt, image_content)
+        invoice = InvoiceData(**extracted_data)
+
+        return jsonify({
+            "success": True,
+            "data": invoice.dict(),
+            "raw_ocr_text": raw_ocr_text,
+            "raw_json_response": raw_json_response,
+            "text_source": text_source,
+            "page_number": page_number,
+            "validation_issues": validate_invoice_arithmetic(invoice)
+        })
+
+    except HTTPException:
+        raise  # Let HTTP errors (e.g. 413 for oversized uploads, raised when the body is first read) reach their handlers
+    except Exception as e:
+        return jsonify({"error": f"Failed to parse invoice: {str(e)}"}), 500
+
+if __name__ == '__main__':
+    app.run(port=5001)
@@ -0,0 +1,225 @@
+"""
+Concurrency benchmark: sync Flask extraction path vs async (ASGI) extraction path.
+
+Both servers are pointed (via GROQ_BASE_URL) at a local fake Groq API that answers every
+chat completion after a fixed delay, so the benchmark measures how many extractions each
+server can keep in flight while waiting on the network, not model speed.
+
+For each concurrency level, `rounds × concurrency` image uploads are sent to /api/extract
+with at most `concurrency` requests in flight. A level is sustainable when every request
+succeeds and the p95 latency stays within `latency_budget ×` the ideal latency (two fake
+LLM calls). The sync server runs with a fixed thread pool, like `gunicorn --threads N`.
+
+Usage (from the backend directory):
+    python benchmark_concurrency.py --levels 10,50,100,200,400 --llm-latency-ms 1000
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import statistics
+import subprocess
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ---------------------------
+# Servers
+# ---------------------------
+
+def serve_fake_groq(port, latency_ms):
+    """Minimal OpenAI-compatible chat completions endpoint with a fixed response delay"""
+    from quart import Quart, request, jsonify
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+
+    fake = Quart("fake_groq")
+
+    @fake.route('/openai/v1/chat/completions', methods=['POST'])
+    async def chat_completions():
+        body = await request.get_json()
+        await asyncio.sleep(latency_ms / 1000)
+        is_json = body.get('response_format', {}).get('type') == 'json_object'
+        content = '{"invoice_number": "BENCH-001", "total_amount": 100.0}' if is_json else "INVOICE BENCH-001"
+        return jsonify({
+            "id": "bench", "object": "chat.completion", "created": 0, "model": body.get('model'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = 4096
+    asyncio.run(serve(fake, config))
+
+
+def serve_sync(port, threads):
+    """api_server.app on a WSGI server with a fixed pool of worker threads"""
+    from werkzeug.serving import BaseWSGIServer
+    import api_server
+
+    class PooledWSGIServer(BaseWSGIServer):
+        request_queue_size = 4096
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._pool = ThreadPoolExecutor(max_workers=threads)
+
+        def process_request(self, request, client_address):
+            self._pool.submit(self._handle_request, request, client_address)
+
+        def _handle_request(self, request, client_address):
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    PooledWSGIServer("127.0.0.1", port, api_server.app).serve_forever()
+
+
+def serve_async(port):
+    """async_api_server.app on hypercorn (single process, single event loop)"""
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+    import async_api_server
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.backlog = 4096
+    asyncio.run(serve(async_api_server.app, config))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, env):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), *args], env=env)
+    port = int(args[args.index('--port') + 1])
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError(f"Server {args} exited with code {process.returncode}")
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Server {args} did not start within 30s")
+
+
+# ---------------------------
+# Load generation
+# ---------------------------
+
+def sample_invoice_png():
+    from PIL import Image, ImageDraw
+
+    img = Image.new('RGB', (1240, 1754), 'white')  # A4 at 150 DPI
+    draw = ImageDraw.Draw(img)
+    for line in range(40):
+        draw.text((80, 80 + line * 40), f"Item {line + 1}    Qty 2    Unit 10.00    Total 20.00", fill='black')
+    output = BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+
+async def run_level(base_url, payload, concurrency, total_requests):
+    import httpx
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=300) as client:
+        async def one_request():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(
+                        '/api/extract',
+                        data={'input_method': 'upload'},
+                        files={'file': ('invoice.png', payload, 'image/png')},
+                    )
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request() for _ in range(total_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'throughput': total_requests / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(0.95 * (len(latencies) - 1))],
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare max sustainable concurrency of the sync and async extraction paths")
+    parser.add_argument('--levels', default='10,50,100,200,400', help="Comma-separated in-flight request counts")
+    parser.add_argument('--rounds', type=int, default=2, help="Requests per level = rounds × concurrency")
+    parser.add_argument('--llm-latency-ms', type=int, default=1000, help="Fake Groq response delay per call")
+    parser.add_argument('--sync-threads', type=int, default=16, help="Worker threads for the sync server")
+    parser.add_argument('--latency-budget', type=float, default=1.5,
+                        help="Max p95 latency, as a multiple of the ideal (2 × llm latency), for a level to count as sustainable")
+    parser.add_argument('--serve', choices=['fake', 'sync', 'async'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == 'fake':
+        return serve_fake_groq(args.port, args.llm_latency_ms)
+    if args.serve == 'sync':
+        return serve_sync(args.port, args.sync_threads)
+    if args.serve == 'async':
+        return serve_async(args.port)
+
+    levels = [int(level) for level in args.levels.split(',')]
+    fake_port, sync_port, async_port = free_port(), free_port(), free_port()
+    env = dict(os.environ, GROQ_API_KEY="benchmark", GROQ_BASE_URL=f"http://127.0.0.1:{fake_port}")
+    payload = sample_invoice_png()
+    ideal_latency = 2 * args.llm_latency_ms / 1000
+
+    processes = [start_server(['--serve', 'fake', '--port', str(fake_port), '--llm-latency-ms', str(args.llm_latency_ms)], env)]
+    try:
+        processes.append(start_server(['--serve', 'sync', '--port', str(sync_port), '--sync-threads', str(args.sync_threads)], env))
+        processes.append(start_server(['--serve', 'async', '--port', str(async_port)], env))
+
+        print(f"Fake LLM latency: {args.llm_latency_ms} ms per call (ideal extraction latency {ideal_latency:.2f}s)")
+        print(f"Sync server threads: {args.sync_threads}, sustainable if p95 <= {args.latency_budget * ideal_latency:.2f}s\n")
+        print(f"{'server':<6} {'in-flight':>9} {'req/s':>8} {'p50 (s)':>8} {'p95 (s)':>8} {'errors':>7}")
+
+        max_sustainable = {}
+        for name, port in [('sync', sync_port), ('async', async_port)]:
+            max_sustainable[name] = 0
+            for concurrency in levels:
+                result = asyncio.run(run_level(f"http://127.0.0.1:{port}", payload, concurrency, args.rounds * concurrency))
+                print(f"{name:<6} {concurrency:>9} {result['throughput']:>8.1f} {result['p50']:>8.2f} {result['p95']:>8.2f} {result['errors']:>7}")
+                if result['errors'] == 0 and result['p95'] <= args.latency_budget * ideal_latency:
+                    max_sustainable[name] = concurrency
+
+        print()
+        for name, concurrency in max_sustainable.items():
+            print(f"Max sustainable concurrency ({name}): {concurrency or f'< {levels[0]}'}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Startup benchmark for the Flask backend.
+
+Measures, in a fresh interpreter, the time to import api_server and answer the
+first /api/health request (readiness), the resident memory at that point, and
+which heavy dependencies were loaded along the way.
+
+Usage (from the backend directory):
+    python benchmark_startup.py [--runs 5]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Dependencies that should only be imported by the routes that need them
+HEAVY_MODULES = ["pandas", "openpyxl", "groq", "pdf2image", "pypdf", "PIL", "requests"]
+
+PROBE = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+import api_server
+imported = time.perf_counter()
+response = api_server.app.test_client().get('/api/health')
+ready = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024  # ru_maxrss is reported in bytes on macOS
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "ready_ms": (ready - start) * 1000,
+    "max_rss_mb": rss_kb / 1024,
+    "health_status": response.status_code,
+    "heavy_modules_loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def run_probe():
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark backend cold start")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters to start")
+    args = parser.parse_args()
+
+    results = [run_probe() for _ in range(args.runs)]
+
+    print(f"Runs: {args.runs}")
+    for key, label in [("import_ms", "Import time"), ("ready_ms", "Time to readiness")]:
+        values = [r[key] for r in results]
+        print(f"{label}: median {statistics.median(values):.1f} ms (min {min(values):.1f}, max {max(values):.1f})")
+    print(f"Max RSS at readiness: {statistics.median(r['max_rss_mb'] for r in results):.1f} MB")
+    print(f"/api/health status: {results[-1]['health_status']}")
+
+    loaded = results[-1]["heavy_modules_loaded"]
+    print(f"Heavy modules loaded at readiness: {', '.join(loaded) if loaded else 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,41 @@
-import pandas as pd
 import os
+import threading
 from datetime import datetime
 from typing import Optional, Dict, List
 from pathlib import Path
+from invoice_summary import InvoiceSummary
+from search_index import InvoiceSearchIndex
+
+# pandas (and openpyxl through it) is imported inside the methods that use it
+# so that importing this module doesn't slow down server startup
 
 class ExcelDatabase:
     def __init__(self, db_path: str = "invoice_database.xlsx"):
         self.db_path = db_path
+        # Serializes the Excel read-modify-write together with the summary and search index
+        # updates, so concurrent requests can't apply deltas computed from the same old row
+        self._write_lock = threading.RLock()
         self.ensure_database_exists()
+        
+        # Aggregates for /api/summary live next to the database file
+        self.summary = InvoiceSummary(os.path.splitext(db_path)[0] + "_summary.json")
+        if not self.summary.loaded:
+            self.rebuild_summary()
+        
+        # Full-text index for /api/search, also kept next to the database file. A large index takes
+        # seconds to load, so it loads in the background; searches and index updates wait for it.
+        self.search_index = InvoiceSearchIndex(os.path.splitext(db_path)[0] + "_search_index.json")
+        threading.Thread(target=self._load_search_index, name="search-index-load", daemon=True).start()
+    
+    def _load_search_index(self):
+        """Load the persisted search index, rebuilding it from the Excel file if it is missing or unreadable"""
+        if not self.search_index.load():
+            self.rebuild_search_index()
     
     def ensure_database_exists(self):
         """Create Excel file with SalesOrderHeader and SalesOrderDetail sheets if it doesn't exist"""
+        import pandas as pd
+        
         if not os.path.exists(self.db_path):
             # Create empty DataFrames with proper structure
             header_df = pd.DataFrame(columns=[
@@ -49,6 +74,8 @@ class ExcelDatabase:
     
     def get_next_order_id(self) -> int:
         """Get the next available OrderID"""
+        import pandas as pd
+        
         try:
             header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
             if len(header_df) == 0:
@@ -59,138 +86,156 @@ class ExcelDatabase:
     
     def save_invoice(self, invoice_data: Dict) -> Dict:
         """Save invoice data to Excel database"""
-        try:
-            # Read existing data
-            header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
-            detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
-            
-            # Generate OrderID
-            order_id = self.get_next_order_id()
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            # Prepare header row
-            header_row = {
-                'OrderID': order_id,
-                'InvoiceNumber': invoice_data.get('invoice_number', ''),
-                'OrderDate': invoice_data.get('invoice_date', ''),
-                'InvoiceDate': invoice_data.get('invoice_date', ''),
-                'DueDate': invoice_data.get('due_date', ''),
-                'CustomerID': '',  # Can be added later
-                'CustomerName': invoice_data.get('customer_name', ''),
-                'VendorName': invoice_data.get('vendor_name', ''),
-                'BillingAddress': invoice_data.get('billing_address', ''),
-                'ShippingAddress': invoice_data.get('shipping_address', ''),
-                'SubTotal': invoice_data.get('subtotal', 0),
-                'Tax': invoice_data.get('tax', 0),
-                'TotalAmount': invoice_data.get('total_amount', 0),
-                'Currency': invoice_data.get('currency', ''),
-                'Status': 'Pending',
-                'CreatedAt': now,
-                'UpdatedAt': now
-            }
-            
-            # Add header row
-            header_df = pd.concat([header_df, pd.DataFrame([header_row])], ignore_index=True)
-            
-            # Prepare detail rows
-            line_items = invoice_data.get('line_items', [])
-            detail_rows = []
-            for idx, item in enumerate(line_items, start=1):
-                detail_row = {
+        import pandas as pd
+        
+        with self._write_lock:
+            try:
+                # Read existing data
+                header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
+                detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
+                
+                # Generate OrderID
+                order_id = self.get_next_order_id()
+                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                
+                # Prepare header row
+                header_row = {
                     'OrderID': order_id,
-                    'LineNumber': idx,
-                    'ItemDescription': item.get('description', ''),
-                    'Quantity': item.get('quantity', 0),
-                    'UnitPrice': item.get('unit_price', 0),
-                    'LineTotal': item.get('total_price', 0),
-                    'CreatedAt': now
+                    'InvoiceNumber': invoice_data.get('invoice_number', ''),
+                    'OrderDate': invoice_data.get('invoice_date', ''),
+                    'InvoiceDate': invoice_data.get('invoice_date', ''),
+                    'DueDate': invoice_data.get('due_date', ''),
+                    'CustomerID': '',  # Can be added later
+                    'CustomerName': invoice_data.get('customer_name', ''),
+                    'VendorName': invoice_data.get('vendor_name', ''),
+                    'BillingAddress': invoice_data.get('billing_address', ''),
+                    'ShippingAddress': invoice_data.get('shipping_address', ''),
+                    'SubTotal': invoice_data.get('subtotal', 0),
+                    'Tax': invoice_data.get('tax', 0),
+                    'TotalAmount': invoice_data.get('total_amount', 0),
+                    'Currency': invoice_data.get('currency', ''),
+                    'Status': 'Pending',
+                    'CreatedAt': now,
+                    'UpdatedAt': now
+                }
+                
+                # Add header row
+                header_df = pd.concat([header_df, pd.DataFrame([header_row])], ignore_index=True)
+                
+                # Prepare detail rows
+                line_items = invoice_data.get('line_items', [])
+                detail_rows = []
+                for idx, item in enumerate(line_items, start=1):
+                    detail_row = {
+                        'OrderID': order_id,
+                        'LineNumber': idx,
+                        'ItemDescription': item.get('description', ''),
+                        'Quantity': item.get('quantity', 0),
+                        'UnitPrice': item.get('unit_price', 0),
+                        'LineTotal': item.get('total_price', 0),
+                        'CreatedAt': now
+                    }
+                    detail_rows.append(detail_row)
+                
+                if detail_rows:
+                    detail_df = pd.concat([detail_df, pd.DataFrame(detail_rows)], ignore_index=True)
+                
+                # Write back to Excel
+                with pd.ExcelWriter(self.db_path, engine='openpyxl') as writer:
+                    header_df.to_excel(writer, sheet_name='SalesOrderHeader', index=False)
+                    detail_df.to_excel(writer, sheet_name='SalesOrderDetail', index=False)
+                
+                self.summary.add(header_row)
+                self.search_index.index_invoice(order_id, header_row, detail_rows, invoice_data.get('raw_ocr_text'))
+                
+                return {
+                    'success': True,
+                    'order_id': order_id,
+                    'message': f'Invoice saved with OrderID: {order_id}'
+                }
+            except Exception as e:
+                return {
+                    'success': False,
+                    'error': str(e)
                 }
-                detail_rows.append(detail_row)
-            
-            if detail_rows:
-                detail_df = pd.concat([detail_df, pd.DataFrame(detail_rows)], ignore_index=True)
-            
-            # Write back to Excel
-            with pd.ExcelWriter(self.db_path, engine='openpyxl') as writer:
-                header_df.to_excel(writer, sheet_name='SalesOrderHeader', index=False)
-                detail_df.to_excel(writer, sheet_name='SalesOrderDetail', index=False)
-            
-            return {
-                'success': True,
-                'order_id': order_id,
-                'message': f'Invoice saved with OrderID: {order_id}'
-            }
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
     
     def update_invoice(self, order_id: int, invoice_data: Dict) -> Dict:
         """Update existing invoice in Excel database"""
-        try:
-            # Read existing data
-            header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
-            detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
-            
-            # Update header
-            mask = header_df['OrderID'] == order_id
-            if not mask.any():
-                return {'success': False, 'error': f'OrderID {order_id} not found'}
-            
-            now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            header_df.loc[mask, 'InvoiceNumber'] = invoice_data.get('invoice_number', '')
-            header_df.loc[mask, 'InvoiceDate'] = invoice_data.get('invoice_date', '')
-            header_df.loc[mask, 'DueDate'] = invoice_data.get('due_date', '')
-            header_df.loc[mask, 'CustomerName'] = invoice_data.get('customer_name', '')
-            header_df.loc[mask, 'VendorName'] = invoice_data.get('vendor_name', '')
-            header_df.loc[mask, 'BillingAddress'] = invoice_data.get('billing_address', '')
-            header_df.loc[mask, 'ShippingAddress'] = invoice_data.get('shipping_address', '')
-            header_df.loc[mask, 'SubTotal'] = invoice_data.get('subtotal', 0)
-            header_df.loc[mask, 'Tax'] = invoice_data.get('tax', 0)
-            header_df.loc[mask, 'TotalAmount'] = invoice_data.get('total_amount', 0)
-            header_df.loc[mask, 'Currency'] = invoice_data.get('currency', '')
-            header_df.loc[mask, 'UpdatedAt'] = now
-            
-            # Remove old detail rows
-            detail_df = detail_df[detail_df['OrderID'] != order_id]
-            
-            # Add new detail rows
-            line_items = invoice_data.get('line_items', [])
-            detail_rows = []
-            for idx, item in enumerate(line_items, start=1):
-                detail_row = {
-                    'OrderID': order_id,
-                    'LineNumber': idx,
-                    'ItemDescription': item.get('description', ''),
-                    'Quantity': item.get('quantity', 0),
-                    'UnitPrice': item.get('unit_price', 0),
-                    'LineTotal': item.get('total_price', 0),
-                    'CreatedAt': now
+        import pandas as pd
+        
+        with self._write_lock:
+            try:
+                # Read existing data
+                header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
+                detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
+                
+                # Update header
+                mask = header_df['OrderID'] == order_id
+                if not mask.any():
+                    return {'success': False, 'error': f'OrderID {order_id} not found'}
+                
+                old_header_row = header_df[mask].iloc[0].to_dict()
+                
+                now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                header_df.loc[mask, 'InvoiceNumber'] = invoice_data.get('invoice_number', '')
+                header_df.loc[mask, 'InvoiceDate'] = invoice_data.get('invoice_date', '')
+                header_df.loc[mask, 'DueDate'] = invoice_data.get('due_date', '')
+                header_df.loc[mask, 'CustomerName'] = invoice_data.get('customer_name', '')
+                header_df.loc[mask, 'VendorName'] = invoice_data.get('vendor_name', '')
+                header_df.loc[mask, 'BillingAddress'] = invoice_data.get('billing_address', '')
+                header_df.loc[mask, 'ShippingAddress'] = invoice_data.get('shipping_address', '')
+                header_df.loc[mask, 'SubTotal'] = invoice_data.get('subtotal', 0)
+                header_df.loc[mask, 'Tax'] = invoice_data.get('tax', 0)
+                header_df.loc[mask, 'TotalAmount'] = invoice_data.get('total_amount', 0)
+                header_df.loc[mask, 'Currency'] = invoice_data.get('currency', '')
+                header_df.loc[mask, 'UpdatedAt'] = now
+                
+                # Remove old detail rows
+                detail_df = detail_df[detail_df['OrderID'] != order_id]
+                
+                # Add new detail rows
+                line_items = invoice_data.get('line_items', [])
+                detail_rows = []
+                for idx, item in enumerate(line_items, start=1):
+                    detail_row = {
+                        'OrderID': order_id,
+                        'LineNumber': idx,
+                        'ItemDescription': item.get('description', ''),
+                        'Quantity': item.get('quantity', 0),
+                        'UnitPrice': item.get('unit_price', 0),
+                        'LineTotal': item.get('total_price', 0),
+                        'CreatedAt': now
+                    }
+                    detail_rows.append(detail_row)
+                
+                if detail_rows:
+                    detail_df = pd.concat([detail_df, pd.DataFrame(detail_rows)], ignore_index=True)
+                
+                # Write back to Excel
+                with pd.ExcelWriter(self.db_path, engine='openpyxl') as writer:
+                    header_df.to_excel(writer, sheet_name='SalesOrderHeader', index=False)
+                    detail_df.to_excel(writer, sheet_name='SalesOrderDetail', index=False)
+                
+                # Apply the delta between the old and new header to the aggregates
+                new_header_row = header_df[mask].iloc[0].to_dict()
+                self.summary.replace(old_header_row, new_header_row)
+                self.search_index.index_invoice(order_id, new_header_row, detail_rows, invoice_data.get('raw_ocr_text'))
+                
+                return {
+                    'success': True,
+                    'order_id': order_id,
+                    'message': f'Invoice {order_id} updated successfully'
+                }
+            except Exception as e:
+                return {
+                    'success': False,
+                    'error': str(e)
                 }
-                detail_rows.append(detail_row)
-            
-            if detail_rows:
-                detail_df = pd.concat([detail_df, pd.DataFrame(detail_rows)], ignore_index=True)
-            
-            # Write back to Excel
-            with pd.ExcelWriter(self.db_path, engine='openpyxl') as writer:
-                header_df.to_excel(writer, sheet_name='SalesOrderHeader', index=False)
-                detail_df.to_excel(writer, sheet_name='SalesOrderDetail', index=False)
-            
-            return {
-                'success': True,
-                'order_id': order_id,
-                'message': f'Invoice {order_id} updated successfully'
-            }
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
     
     def get_all_invoices(self) -> Dict:
         """Get all invoices from database"""
+        import pandas as pd
+        
         try:
             header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
             detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
@@ -212,6 +257,8 @@ class ExcelDatabase:
     
     def get_invoice_by_id(self, order_id: int) -> Dict:
         """Get specific invoice by OrderID"""
+        import pandas as pd
+        
         try:
             header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
             detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
@@ -232,3 +279,72 @@ class ExcelDatabase:
                 'success': False,
                 'error': str(e)
             }
+    
+    def get_summary(self, group_by: Optional[List[str]] = None) -> Dict:
+        """Get invoice totals grouped by the given dimensions (vendor, currency, month, status)"""
+        try:
+            return {
+                'success': True,
+                'groups': self.summary.query(group_by)
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
+    def rebuild_summary(self) -> Dict:
+        """Recompute the summary aggregates from the SalesOrderHeader sheet"""
+        import pandas as pd
+        
+        with self._write_lock:
+            try:
+                header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
+                self.summary.rebuild(header_df.to_dict('records'))
+                
+                return {
+                    'success': True,
+                    'message': f'Summary rebuilt from {len(header_df)} invoice(s)'
+                }
+            except Exception as e:
+                return {
+                    'success': False,
+                    'error': str(e)
+                }
+    
+    def search_invoices(self, query: str, page: int = 1, page_size: int = 20) -> Dict:
+        """Full-text search over stored invoices, returning ranked OrderIDs"""
+        try:
+            result = self.search_index.search(query, page, page_size)
+            return {
+                'success': True,
+                'query': query,
+                'page': page,
+                'page_size': page_size,
+                **result
+            }
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+    
+    def rebuild_search_index(self) -> Dict:
+        """Re-index all invoices from the SalesOrderHeader and SalesOrderDetail sheets"""
+        import pandas as pd
+        
+        with self._write_lock:
+            try:
+                header_df = pd.read_excel(self.db_path, sheet_name='SalesOrderHeader')
+                detail_df = pd.read_excel(self.db_path, sheet_name='SalesOrderDetail')
+                self.search_index.rebuild(header_df.to_dict('records'), detail_df.to_dict('records'))
+                
+                return {
+                    'success': True,
+                    'message': f'Search index rebuilt from {len(header_df)} invoice(s)'
+                }
+            except Exception as e:
+                return {
+                    'success': False,
+                    'error': str(e)
+                }
@@ -0,0 +1,198 @@
+import os
+import json
+import math
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Summary dimensions and the SalesOrderHeader column each one is derived from
+SUMMARY_DIMENSIONS = {
+    'vendor': 'VendorName',
+    'currency': 'Currency',
+    'month': 'InvoiceDate',
+    'status': 'Status',
+}
+
+# Amount columns summed per group
+SUMMARY_AMOUNTS = {
+    'subtotal': 'SubTotal',
+    'tax': 'Tax',
+    'total_amount': 'TotalAmount',
+}
+
+UNKNOWN_VALUE = 'Unknown'
+
+# Date formats tried (in order) when bucketing invoices by month
+_DATE_FORMATS = [
+    '%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%m/%d/%Y', '%d.%m.%Y', '%d-%m-%Y',
+    '%B %d, %Y', '%b %d, %Y', '%d %B %Y', '%d %b %Y',
+]
+
+
+def _is_missing(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    return str(value).strip() == ''
+
+
+def _to_amount(value) -> float:
+    """Convert a stored amount to float, treating missing or invalid values as 0"""
+    if _is_missing(value):
+        return 0.0
+    try:
+        amount = float(value)
+    except (ValueError, TypeError):
+        return 0.0
+    return amount if math.isfinite(amount) else 0.0
+
+
+def invoice_month(invoice_date) -> str:
+    """Bucket an invoice date into 'YYYY-MM', or 'Unknown' if it can't be parsed"""
+    if _is_missing(invoice_date):
+        return UNKNOWN_VALUE
+    if isinstance(invoice_date, datetime):
+        return invoice_date.strftime('%Y-%m')
+
+    date_str = str(invoice_date).strip()
+    try:
+        return datetime.fromisoformat(date_str).strftime('%Y-%m')
+    except ValueError:
+        pass
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(date_str, date_format).strftime('%Y-%m')
+        except ValueError:
+            continue
+    return UNKNOWN_VALUE
+
+
+class InvoiceSummary:
+    """
+    Invoice totals grouped by vendor, currency, month and status.
+    Kept up to date incrementally on every save/update and persisted as JSON,
+    so summary queries cost O(number of groups) rather than O(number of invoices).
+    """
+    def __init__(self, summary_path: str):
+        self.summary_path = summary_path
+        self._lock = threading.Lock()
+        self._groups: Dict[tuple, Dict] = {}
+        self.loaded = self._load()
+
+    def _load(self) -> bool:
+        """Load persisted aggregates. Returns False if they are missing or unreadable."""
+        if not os.path.exists(self.summary_path):
+            return False
+        try:
+            with open(self.summary_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+            if stored.get('dimensions') != list(SUMMARY_DIMENSIONS):
+                return False
+            self._groups = {tuple(group.pop('key')): group for group in stored['groups']}
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            self._groups = {}
+            return False
+
+    def _save(self):
+        """Persist aggregates atomically (write to a temp file, then rename)"""
+        stored = {
+            'dimensions': list(SUMMARY_DIMENSIONS),
+            'groups': [{'key': list(key), **totals} for key, totals in self._groups.items()],
+        }
+        temp_path = f"{self.summary_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(stored, f)
+        os.replace(temp_path, self.summary_path)
+
+    @staticmethod
+    def _group_key(header_row: Dict) -> tuple:
+        key = []
+        for dimension, column in SUMMARY_DIMENSIONS.items():
+            value = header_row.get(column)
+            if dimension == 'month':
+                key.append(invoice_month(value))
+            else:
+                key.append(UNKNOWN_VALUE if _is_missing(value) else str(value).strip())
+        return tuple(key)
+
+    def _apply(self, header_row: Dict, sign: int):
+        key = self._group_key(header_row)
+        totals = self._groups.setdefault(key, {'count': 0, **{name: 0.0 for name in SUMMARY_AMOUNTS}})
+        totals['count'] += sign
+        for name, column in SUMMARY_AMOUNTS.items():
+            totals[name] += sign * _to_amount(header_row.get(column))
+        if totals['count'] <= 0:
+            del self._groups[key]
+
+    def add(self, header_row: Dict):
+        """Add a newly saved SalesOrderHeader row to the aggregates"""
+        with self._lock:
+            self._apply(header_row, 1)
+            self._save()
+
+    def replace(self, old_row: Dict, new_row: Dict):
+        """Apply an update: remove the old row's contribution and add the new one"""
+        with self._lock:
+            self._apply(old_row, -1)
+            self._apply(new_row, 1)
+            self._save()
+
+    def rebuild(self, header_rows: List[Dict]):
+        """Recompute the aggregates from scratch"""
+        with self._lock:
+            self._groups = {}
+            for header_row in header_rows:
+                self._apply(header_row, 1)
+            self._save()
+            self.loaded = True
+
+    def query(self, group_by: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Roll the stored groups up to the requested dimensions (default: all of them).
+        Currency is always kept in the grouping so amounts in different currencies are never added up.
+        Raises ValueError for unknown dimensions.
+        """
+        group_by = list(SUMMARY_DIMENSIONS) if group_by is None else list(group_by)
+        unknown = [dimension for dimension in group_by if dimension not in SUMMARY_DIMENSIONS]
+        if unknown:
+            raise ValueError(f"Unknown summary dimension(s): {', '.join(unknown)}. "
+                             f"Use: {', '.join(SUMMARY_DIMENSIONS)}")
+        if 'currency' not in group_by:
+            group_by.append('currency')
+
+        positions = [list(SUMMARY_DIMENSIONS).index(dimension) for dimension in group_by]
+        rolled_up: Dict[tuple, Dict] = {}
+        with self._lock:
+            for key, totals in self._groups.items():
+                sub_key = tuple(key[pos] for pos in positions)
+                group = rolled_up.setdefault(sub_key, {'count': 0, **{name: 0.0 for name in SUMMARY_AMOUNTS}})
+                group['count'] += totals['count']
+                for name in SUMMARY_AMOUNTS:
+                    group[name] += totals[name]
+
+        return [
+            {
+                **dict(zip(group_by, sub_key)),
+                'count': totals['count'],
+                **{name: round(totals[name], 2) for name in SUMMARY_AMOUNTS},
+            }
+            for sub_key, totals in sorted(rolled_up.items())
+        ]
+
+
+if __name__ == '__main__':
+    import argparse
+    from excel_handler import ExcelDatabase
+
+    parser = argparse.ArgumentParser(description="Invoice summary aggregates")
+    parser.add_argument('command', choices=['rebuild'], help="rebuild: recompute aggregates from the Excel database")
+    parser.add_argument('--db', default='invoice_database.xlsx', help="Path to the Excel database")
+    args = parser.parse_args()
+
+    result = ExcelDatabase(args.db).rebuild_summary()
+    if result['success']:
+        print(result['message'])
+    else:
+        raise SystemExit(f"Failed to rebuild summary: {result['error']}")
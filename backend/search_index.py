@@ -0,0 +1,264 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+# Indexed SalesOrderHeader/SalesOrderDetail columns and their ranking weights
+HEADER_FIELD_WEIGHTS = {
+    'InvoiceNumber': 3.0,
+    'VendorName': 3.0,
+    'CustomerName': 2.0,
+    'BillingAddress': 1.0,
+    'ShippingAddress': 1.0,
+}
+DETAIL_FIELD_WEIGHTS = {
+    'ItemDescription': 2.0,
+}
+# Raw OCR text is noisy and long, so each occurrence counts for less
+OCR_TEXT_WEIGHT = 0.5
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text) -> List[str]:
+    """Lowercase word tokens (any script); single letters are dropped, single digits kept"""
+    if text is None or (isinstance(text, float) and math.isnan(text)):
+        return []
+    return [token for token in _TOKEN_PATTERN.findall(str(text).lower()) if len(token) > 1 or token.isdigit()]
+
+
+def _doc_id(order_id) -> str:
+    """Normalize OrderIDs read back from Excel (e.g. 3.0) to a stable key"""
+    return str(int(float(order_id)))
+
+
+class InvoiceSearchIndex:
+    """
+    Persistent inverted index over stored invoices.
+    Only per-invoice term weights are persisted; the postings lists are rebuilt in memory on load.
+    Each save/update appends one entry to a change log next to the snapshot file, so writes cost
+    O(size of the invoice); the log is folded into the snapshot on rebuild.
+    """
+    def __init__(self, index_path: str):
+        self.index_path = index_path
+        self.log_path = f"{index_path}.log"
+        self._lock = threading.Lock()
+        # OrderID (as str) -> {'terms': {term: weight}, 'ocr_terms': {term: count}}
+        self._docs: Dict[str, Dict] = {}
+        # term -> {OrderID: weight}
+        self._postings: Dict[str, Dict[str, float]] = {}
+        # OrderID -> sum of term weights, for BM25 length normalization
+        self._lengths: Dict[str, float] = {}
+        self._total_length = 0.0
+        # File writes happen outside _lock so searches never wait on disk. _log_lock is taken
+        # before _lock is released, so writes reach disk in the order they were applied.
+        self._log_lock = threading.Lock()
+        # Set once load() has finished; until then every other method waits for it
+        self._ready = threading.Event()
+        self.loaded = False
+
+    def load(self) -> bool:
+        """
+        Load the snapshot and replay the change log on top of it.
+        Returns False if the index is missing or unreadable (it is then left empty and needs a rebuild).
+        """
+        try:
+            self.loaded = self._load()
+            return self.loaded
+        finally:
+            self._ready.set()
+
+    def _load(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                docs = json.load(f)['docs']
+            for order_id, doc in docs.items():
+                self._add_doc(order_id, doc)
+            for order_id, doc in self._read_log():
+                self._remove_doc(order_id)
+                self._add_doc(order_id, doc)
+            return True
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            self._docs, self._postings, self._lengths, self._total_length = {}, {}, {}, 0.0
+            return False
+
+    def _read_log(self) -> List[tuple]:
+        """Read the change log, dropping an incomplete last entry left by an interrupted write"""
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path, 'rb') as f:
+            data = f.read()
+        complete_length = data.rfind(b'\n') + 1
+        if complete_length < len(data):
+            # Cut it off so the next append starts on a fresh line
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(complete_length)
+        entries = []
+        for line in data[:complete_length].splitlines():
+            entry = json.loads(line)
+            entries.append((entry['order_id'], entry['doc']))
+        return entries
+
+    def _append_log(self, line: str):
+        """Append one change log entry. Must be called while holding _log_lock."""
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def _write_snapshot(self, docs: Dict[str, Dict]):
+        """
+        Persist all docs atomically (write to a temp file, then rename) and clear the change log.
+        Must be called while holding _log_lock.
+        """
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'docs': docs}, f)
+        os.replace(temp_path, self.index_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    @staticmethod
+    def _doc_weights(doc: Dict) -> Dict[str, float]:
+        weights = dict(doc['terms'])
+        for term, count in doc['ocr_terms'].items():
+            weights[term] = weights.get(term, 0.0) + count * OCR_TEXT_WEIGHT
+        return weights
+
+    def _add_doc(self, order_id: str, doc: Dict):
+        self._docs[order_id] = doc
+        weights = self._doc_weights(doc)
+        for term, weight in weights.items():
+            self._postings.setdefault(term, {})[order_id] = weight
+        self._lengths[order_id] = sum(weights.values())
+        self._total_length += self._lengths[order_id]
+
+    def _remove_doc(self, order_id: str) -> Optional[Dict]:
+        doc = self._docs.pop(order_id, None)
+        if doc is None:
+            return None
+        for term in self._doc_weights(doc):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(order_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(order_id, 0.0)
+        return doc
+
+    @staticmethod
+    def _build_doc(header_row: Dict, detail_rows: List[Dict], raw_ocr_text: Optional[str]) -> Dict:
+        terms = Counter()
+        for column, weight in HEADER_FIELD_WEIGHTS.items():
+            for token in tokenize(header_row.get(column)):
+                terms[token] += weight
+        for detail_row in detail_rows:
+            for column, weight in DETAIL_FIELD_WEIGHTS.items():
+                for token in tokenize(detail_row.get(column)):
+                    terms[token] += weight
+        return {
+            'terms': dict(terms),
+            'ocr_terms': dict(Counter(tokenize(raw_ocr_text))),
+        }
+
+    def index_invoice(self, order_id, header_row: Dict, detail_rows: List[Dict], raw_ocr_text: Optional[str] = None):
+        """
+        Add or replace an invoice in the index.
+        If raw_ocr_text is None, the OCR text previously indexed for this invoice is kept.
+        """
+        order_id = _doc_id(order_id)
+        self._ready.wait()
+        with self._lock:
+            old_doc = self._remove_doc(order_id)
+            doc = self._build_doc(header_row, detail_rows, raw_ocr_text)
+            if raw_ocr_text is None and old_doc is not None:
+                doc['ocr_terms'] = old_doc['ocr_terms']
+            self._add_doc(order_id, doc)
+            line = json.dumps({'order_id': order_id, 'doc': doc})
+            self._log_lock.acquire()
+        try:
+            self._append_log(line)
+        finally:
+            self._log_lock.release()
+
+    def rebuild(self, header_rows: List[Dict], detail_rows: List[Dict]):
+        """Re-index all invoices from scratch, keeping previously indexed OCR text"""
+        details_by_order: Dict[str, List[Dict]] = {}
+        for detail_row in detail_rows:
+            details_by_order.setdefault(_doc_id(detail_row.get('OrderID')), []).append(detail_row)
+
+        self._ready.wait()
+        with self._lock:
+            old_docs = self._docs
+            self._docs, self._postings, self._lengths, self._total_length = {}, {}, {}, 0.0
+            for header_row in header_rows:
+                order_id = _doc_id(header_row.get('OrderID'))
+                doc = self._build_doc(header_row, details_by_order.get(order_id, []), None)
+                if order_id in old_docs:
+                    doc['ocr_terms'] = old_docs[order_id]['ocr_terms']
+                self._add_doc(order_id, doc)
+            self.loaded = True
+            # A shallow copy is enough: doc dicts are replaced on update, never mutated
+            docs = dict(self._docs)
+            self._log_lock.acquire()
+        try:
+            self._write_snapshot(docs)
+        finally:
+            self._log_lock.release()
+
+    def search(self, query: str, page: int = 1, page_size: int = 20) -> Dict:
+        """
+        Rank invoices for a free-text query with BM25 over field-weighted term frequencies.
+        Invoices matching more distinct query terms rank first.
+        Returns the total number of matches and one page of {'order_id', 'score'} results.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        self._ready.wait()
+        with self._lock:
+            doc_count = len(self._docs)
+            avg_length = self._total_length / doc_count if doc_count else 0.0
+            scores: Dict[str, float] = {}
+            matched_terms: Counter = Counter()
+
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for order_id, weight in postings.items():
+                    norm = 1 - BM25_B + BM25_B * self._lengths[order_id] / avg_length if avg_length else 1.0
+                    scores[order_id] = scores.get(order_id, 0.0) + idf * weight * (BM25_K1 + 1) / (weight + BM25_K1 * norm)
+                    matched_terms[order_id] += 1
+
+        ranked = sorted(scores, key=lambda order_id: (-matched_terms[order_id], -scores[order_id], -int(order_id)))
+        start = (page - 1) * page_size
+        return {
+            'total': len(ranked),
+            'results': [
+                {'order_id': int(order_id), 'score': round(scores[order_id], 4)}
+                for order_id in ranked[start:start + page_size]
+            ]
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+    from excel_handler import ExcelDatabase
+
+    parser = argparse.ArgumentParser(description="Invoice full-text search index")
+    parser.add_argument('command', choices=['rebuild'], help="rebuild: re-index all invoices from the Excel database")
+    parser.add_argument('--db', default='invoice_database.xlsx', help="Path to the Excel database")
+    args = parser.parse_args()
+
+    result = ExcelDatabase(args.db).rebuild_search_index()
+    if result['success']:
+        print(result['message'])
+    else:
+        raise SystemExit(f"Failed to rebuild search index: {result['error']}")
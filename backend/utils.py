@@ -1,13 +1,17 @@
+import os
 import json
+import math
+import re
 import base64
-import requests
-from PIL import Image
+import shutil
+import tempfile
+import threading
 from io import BytesIO
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel, Field
-from groq import Groq
-from pdf2image import convert_from_bytes
-from pypdf import PdfReader
+
+# Heavy dependencies (groq, PIL, pdf2image, pypdf, requests) are imported inside the
+# functions that use them so that importing this module stays cheap at server startup
 
 
 # ---------------------------
@@ -68,78 +72,300 @@ class InvoiceData(BaseModel):
     )
 
 
+# ---------------------------
+# Arithmetic Validation
+# ---------------------------
+
+# Amounts are compared with an absolute tolerance of one cent per summed term.
+# Line totals also get a relative tolerance for rounded unit prices on large quantities.
+ARITHMETIC_ABS_TOLERANCE = 0.01
+ARITHMETIC_REL_TOLERANCE = 0.001
+
+_FIELD_PATH_PATTERN = re.compile(r"^line_items\[(\d+)\]\.(\w+)$")
+
+
+def _amounts_match(expected: float, actual: float, terms: int = 1, rel_tol: float = 0.0) -> bool:
+    return math.isclose(expected, actual, rel_tol=rel_tol, abs_tol=ARITHMETIC_ABS_TOLERANCE * terms)
+
+
+def validate_invoice_arithmetic(invoice: InvoiceData) -> List[Dict]:
+    """
+    Check line items and header totals for arithmetic consistency.
+    Returns a list of issues, each naming the inconsistent fields (e.g. "line_items[0].total_price").
+    Checks that cannot be evaluated because a value is missing are skipped.
+    """
+    issues = []
+    line_items = invoice.line_items or []
+    
+    # quantity × unit_price = total_price for every line
+    for idx, item in enumerate(line_items):
+        if item.quantity is None or item.unit_price is None or item.total_price is None:
+            continue
+        expected = item.quantity * item.unit_price
+        if not _amounts_match(expected, item.total_price, rel_tol=ARITHMETIC_REL_TOLERANCE):
+            issues.append({
+                'check': 'line_total',
+                'fields': [f'line_items[{idx}].quantity', f'line_items[{idx}].unit_price', f'line_items[{idx}].total_price'],
+                'expected': round(expected, 2),
+                'actual': item.total_price,
+                'message': f'Line {idx + 1}: quantity × unit_price = {expected:.2f}, but total_price is {item.total_price}'
+            })
+    
+    # Sum of line totals = subtotal
+    line_totals = [item.total_price for item in line_items]
+    if invoice.subtotal is not None and line_totals and None not in line_totals:
+        expected = sum(line_totals)
+        if not _amounts_match(expected, invoice.subtotal, terms=len(line_totals)):
+            issues.append({
+                'check': 'subtotal',
+                'fields': ['subtotal'],
+                'expected': round(expected, 2),
+                'actual': invoice.subtotal,
+                'message': f'Sum of line totals is {expected:.2f}, but subtotal is {invoice.subtotal}'
+            })
+    
+    # subtotal + tax = total_amount
+    if invoice.subtotal is not None and invoice.total_amount is not None:
+        expected = invoice.subtotal + (invoice.tax or 0)
+        if not _amounts_match(expected, invoice.total_amount, terms=2):
+            issues.append({
+                'check': 'total_amount',
+                'fields': ['subtotal', 'tax', 'total_amount'],
+                'expected': round(expected, 2),
+                'actual': invoice.total_amount,
+                'message': f'subtotal + tax = {expected:.2f}, but total_amount is {invoice.total_amount}'
+            })
+    
+    return issues
+
+
+def get_flagged_fields(issues: List[Dict]) -> List[str]:
+    """Unique field paths referenced by validation issues, in order of first appearance"""
+    fields = []
+    for issue in issues:
+        for field in issue['fields']:
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def get_field_value(invoice_data: Dict, field_path: str):
+    """Read a value by field path ("subtotal" or "line_items[0].quantity")"""
+    match = _FIELD_PATH_PATTERN.match(field_path)
+    if match:
+        line_items = invoice_data.get('line_items') or []
+        idx = int(match.group(1))
+        return line_items[idx].get(match.group(2)) if idx < len(line_items) else None
+    return invoice_data.get(field_path)
+
+
+def parse_amount(value) -> Optional[float]:
+    """
+    Coerce a model-returned numeric value to float, or None for null/empty.
+    Accepts numbers and numeric strings with currency symbols, spaces and thousands separators
+    ("$1,265.00", "1.265,00 €"). Raises ValueError for anything else.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"Not a number: {value!r}")
+    if isinstance(value, (int, float)):
+        amount = float(value)
+    elif isinstance(value, str) and re.fullmatch(r"\s*[-+]?(\d+\.?\d*|\.\d+)(e[-+]?\d+)?\s*", value, re.IGNORECASE):
+        amount = float(value)
+    elif isinstance(value, str):
+        text = re.sub(r"[^\d.,\-]", "", value)
+        if not text:
+            if value.strip().lower() in ('', 'null', 'none', 'n/a'):
+                return None
+            raise ValueError(f"Not a number: {value!r}")
+        # The last of '.' and ',' is the decimal separator when both appear; a lone ','
+        # is decimal only when followed by 1-2 digits ("12,50" vs "1,265")
+        if '.' in text and ',' in text:
+            decimal = '.' if text.rfind('.') > text.rfind(',') else ','
+            text = text.replace(',' if decimal == '.' else '.', '').replace(',', '.')
+        elif ',' in text:
+            text = text.replace(',', '.') if re.search(r",\d{1,2}$", text) else text.replace(',', '')
+        amount = float(text)
+        if value.strip().startswith('(') and value.strip().endswith(')'):
+            amount = -amount  # Accounting notation for negative amounts
+    else:
+        raise ValueError(f"Not a number: {value!r}")
+    if not math.isfinite(amount):
+        raise ValueError(f"Not a finite number: {value!r}")
+    return amount
+
+
+def clean_field_corrections(corrections, fields: List[str]) -> Tuple[Dict, List[str]]:
+    """
+    Keep only the requested fields from model-returned corrections, coerced to float or None.
+    Returns: (corrections, dropped_fields) where dropped_fields were missing or not numeric.
+    """
+    if not isinstance(corrections, dict):
+        return {}, list(fields)
+    
+    cleaned, dropped = {}, []
+    for field in fields:
+        if field not in corrections:
+            dropped.append(field)
+            continue
+        try:
+            cleaned[field] = parse_amount(corrections[field])
+        except ValueError:
+            dropped.append(field)
+    return cleaned, dropped
+
+
+def apply_field_corrections(invoice_data: Dict, corrections: Dict) -> Dict:
+    """
+    Return a copy of invoice_data with corrected values applied by field path.
+    Paths that don't refer to an existing field are ignored.
+    """
+    updated = dict(invoice_data)
+    updated['line_items'] = [dict(item) for item in (invoice_data.get('line_items') or [])]
+    
+    for field_path, value in corrections.items():
+        match = _FIELD_PATH_PATTERN.match(field_path)
+        if match:
+            idx, field = int(match.group(1)), match.group(2)
+            if idx < len(updated['line_items']) and field in LineItem.model_fields:
+                updated['line_items'][idx][field] = value
+        elif field_path in InvoiceData.model_fields and field_path != 'line_items':
+            updated[field_path] = value
+    
+    return updated
+
+
 # -----------------------------------
 # LLaMA Client Wrapper using Groq Api
 # -----------------------------------
 
-class GroqClient:
-    def __init__(self, api_key):
-        self.client = Groq(api_key=api_key)
-    
-    def extract_raw_text(self, image_content, model="meta-llama/llama-4-scout-17b-16e-instruct"):
-        """Extract raw text from image using OCR"""
-        ocr_prompt = """
+DEFAULT_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+OCR_PROMPT = """
         You are an OCR system. Extract ALL text from this invoice image exactly as it appears.
         Return the raw text content in a simple text format, preserving the layout and structure as much as possible.
         Do not interpret or structure the data, just extract the raw text.
         """
+
+
+def build_extraction_prompt(text_layer: Optional[str] = None, has_image: bool = True) -> str:
+    """Prompt for structured extraction, either from the image or from a PDF text layer"""
+    if text_layer is None:
+        return f"""
+        You are an intelligent OCR extraction agent capable of understanding and processing documents in multiple languages.
+        Given an image of an invoice (which may have been converted from a PDF), extract all relevant information in structured JSON format.
+        The JSON object must use the schema: {json.dumps(InvoiceData.model_json_schema(), indent=2)}
+        If any field cannot be found in the invoice, return it as null. Return the final result strictly in JSON format.
+        """
+    
+    return f"""
+        You are an intelligent extraction agent capable of understanding and processing documents in multiple languages.
+        Below is the text layer of an invoice PDF page{" together with a low-resolution image of the page for layout reference" if has_image else ""}.
+        Extract all relevant information in structured JSON format.
+        The JSON object must use the schema: {json.dumps(InvoiceData.model_json_schema(), indent=2)}
+        If any field cannot be found in the invoice, return it as null. Return the final result strictly in JSON format.
         
-        # Ensure image_content is properly formatted
-        if isinstance(image_content, dict) and "type" in image_content:
-            content_item = image_content
-        else:
-            content_item = {
-                "type": "image_url",
-                "image_url": {"url": image_content} if isinstance(image_content, str) else image_content
-            }
-        
-        messages = [{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": ocr_prompt},
-                content_item
-            ]
-        }]
-        
+        Invoice text:
+        {text_layer}
+        """
+
+
+def _build_messages(prompt, image_content=None):
+    """Build a single user message with the prompt and (optionally) the image"""
+    content = [{"type": "text", "text": prompt}]
+    
+    # Ensure image_content is properly formatted
+    if image_content is None:
+        pass  # Text-only request (e.g. from a PDF text layer)
+    elif isinstance(image_content, dict) and "type" in image_content:
+        content.append(image_content)
+    else:
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": image_content} if isinstance(image_content, str) else image_content
+        })
+    
+    return [{
+        "role": "user",
+        "content": content
+    }]
+
+
+def _ocr_request(image_content, model):
+    return dict(
+        model=model,
+        messages=_build_messages(OCR_PROMPT, image_content),
+        temperature=0.1,
+        max_completion_tokens=2048,
+        stream=False,
+    )
+
+
+def _extraction_request(prompt, image_content, model, max_completion_tokens):
+    return dict(
+        model=model,
+        messages=_build_messages(prompt, image_content),
+        temperature=0.4,
+        max_completion_tokens=max_completion_tokens,
+        stream=False,
+        response_format={"type": "json_object"},
+    )
+
+
+class GroqClient:
+    def __init__(self, api_key):
+        from groq import Groq
+        self.client = Groq(api_key=api_key)
+    
+    def extract_raw_text(self, image_content, model=DEFAULT_MODEL):
+        """Extract raw text from image using OCR"""
+        try:
+            response = self.client.chat.completions.create(**_ocr_request(image_content, model))
+            
+            return response.choices[0].message.content
+        except Exception as e:
+            raise ValueError(f"Groq API error during OCR: {str(e)}")
+    
+    def extract_invoice_data(self, prompt, image_content=None, model=DEFAULT_MODEL, max_completion_tokens=1024):
+        """Extract structured invoice data. Pass image_content=None for a text-only request."""
         try:
             response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.1,
-                max_completion_tokens=2048,
-                stream=False,
+                **_extraction_request(prompt, image_content, model, max_completion_tokens)
             )
             
+            raw_json = response.choices[0].message.content
+            parsed_data = json.loads(raw_json)
+            
+            return parsed_data, raw_json
+        except Exception as e:
+            raise ValueError(f"Groq API error during extraction: {str(e)}")
+
+
+class AsyncGroqClient:
+    """
+    Async variant of GroqClient for the async server. Requests are awaited instead of
+    blocking a thread, so one process can keep many LLM calls in flight.
+    Create it inside the running event loop and reuse it across requests (it pools connections).
+    """
+    def __init__(self, api_key):
+        from groq import AsyncGroq
+        self.client = AsyncGroq(api_key=api_key)
+    
+    async def extract_raw_text(self, image_content, model=DEFAULT_MODEL):
+        """Extract raw text from image using OCR"""
+        try:
+            response = await self.client.chat.completions.create(**_ocr_request(image_content, model))
+            
             return response.choices[0].message.content
         except Exception as e:
             raise ValueError(f"Groq API error during OCR: {str(e)}")
     
-    def extract_invoice_data(self, prompt, image_content, model="meta-llama/llama-4-scout-17b-16e-instruct"):
-        # Ensure image_content is properly formatted
-        if isinstance(image_content, dict) and "type" in image_content:
-            content_item = image_content
-        else:
-            content_item = {
-                "type": "image_url",
-                "image_url": {"url": image_content} if isinstance(image_content, str) else image_content
-            }
-        
-        messages = [{
-            "role": "user",
-            "content": [
-                {"type": "text", "text": prompt},
-                content_item
-            ]
-        }]
-        
+    async def extract_invoice_data(self, prompt, image_content=None, model=DEFAULT_MODEL, max_completion_tokens=1024):
+        """Extract structured invoice data. Pass image_content=None for a text-only request."""
         try:
-            response = self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.4,
-                max_completion_tokens=1024,
-                stream=False,
-                response_format={"type": "json_object"},
+            response = await self.client.chat.completions.create(
+                **_extraction_request(prompt, image_content, model, max_completion_tokens)
             )
             
             raw_json = response.choices[0].message.content
@@ -148,13 +374,147 @@ class GroqClient:
             return parsed_data, raw_json
         except Exception as e:
             raise ValueError(f"Groq API error during extraction: {str(e)}")
+    
+    async def close(self):
+        await self.client.close()
 
 
 # ---------------------------
 # Image Handling Utilities
 # ---------------------------
 
-def process_pdf_upload(uploaded_file, page_number: int = 0) -> Tuple[Optional[bytes], Optional[str], int]:
+# Minimum amount of text a PDF page must carry before its text layer is trusted
+MIN_TEXT_LAYER_CHARS = 100
+# Minimum share of alphanumeric characters (ignoring whitespace) in a usable text layer
+MIN_TEXT_LAYER_ALNUM_RATIO = 0.5
+# Share of the page covered by images above which the page is treated as a scan
+SCANNED_PAGE_IMAGE_COVERAGE = 0.5
+# Rasterization DPI for the normal (OCR) path and for pages that already have a text layer
+DEFAULT_PDF_DPI = 300
+TEXT_LAYER_PDF_DPI = 100
+
+# Largest page (in pixels, after rasterization) or image accepted for processing.
+# The default fits an A3 page at 300 DPI.
+MAX_PAGE_PIXELS = int(os.getenv("MAX_PAGE_PIXELS", 20_000_000))
+# Number of PDF rasterizations allowed to run at the same time across all request threads.
+# Together with MAX_PAGE_PIXELS this bounds the memory used by rasterization.
+MAX_CONCURRENT_RASTERIZATIONS = int(os.getenv("MAX_CONCURRENT_RASTERIZATIONS", 2))
+
+_rasterization_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RASTERIZATIONS)
+# Seconds to wait when fetching an image URL (connect and each read)
+IMAGE_URL_TIMEOUT = float(os.getenv("IMAGE_URL_TIMEOUT", 10))
+
+
+def check_pixel_count(width: float, height: float, description: str = "Page"):
+    """Reject pages/images whose pixel count exceeds MAX_PAGE_PIXELS"""
+    pixels = int(width) * int(height)
+    if pixels > MAX_PAGE_PIXELS:
+        raise ValueError(
+            f"{description} is too large: {int(width)}x{int(height)} pixels "
+            f"exceeds the limit of {MAX_PAGE_PIXELS} pixels"
+        )
+
+
+def check_page_pixel_count(page, dpi: float, description: str = "Page"):
+    """
+    Reject a pypdf page that would rasterize above MAX_PAGE_PIXELS at the given DPI.
+    Pages are always rendered with use_cropbox=True, so the crop box is what gets rendered;
+    page boxes are in user units (1/72 inch, scaled by /UserUnit when the page sets one).
+    """
+    # Poppler may or may not honour /UserUnit, so only ever let it make the estimate larger
+    user_unit = max(float(page['/UserUnit']), 1.0) if '/UserUnit' in page else 1.0
+    scale = user_unit * dpi / 72
+    page_box = page.cropbox
+    check_pixel_count(float(page_box.width) * scale, float(page_box.height) * scale, description)
+
+
+def extract_page_text(page) -> Tuple[Optional[str], float]:
+    """
+    Extract the text layer of a pypdf page and measure how much of the page is covered by images.
+    Returns: (text, image_coverage) with image_coverage between 0 and 1.
+    """
+    image_area = [0.0]
+    try:
+        resources = page.get('/Resources')
+        xobjects = resources.get_object().get('/XObject') if resources is not None else None
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+    except Exception:
+        xobjects = {}
+    
+    def count_images(operator, operands, cm, tm):
+        # An image is drawn into the unit square mapped by the current transformation matrix
+        if operator == b'Do' and operands:
+            xobject = xobjects.get(operands[0])
+            if xobject is not None and xobject.get_object().get('/Subtype') == '/Image':
+                image_area[0] += abs(cm[0] * cm[3] - cm[1] * cm[2])
+    
+    try:
+        text = page.extract_text(visitor_operand_before=count_images)
+    except Exception:
+        return None, 0.0
+    
+    page_area = float(page.mediabox.width) * float(page.mediabox.height)
+    image_coverage = min(image_area[0] / page_area, 1.0) if page_area > 0 else 0.0
+    return text, image_coverage
+
+
+def is_usable_text_layer(text: Optional[str], image_coverage: float = 0.0) -> bool:
+    """
+    Check whether text extracted from a PDF page is good enough to replace OCR.
+    Pages dominated by an image are scans; their text layer is only trusted if it
+    actually reads like an invoice, not just a print stamp, page number or fax banner.
+    """
+    if not text:
+        return False
+    
+    visible_chars = [c for c in text if not c.isspace()]
+    if len(visible_chars) < MIN_TEXT_LAYER_CHARS:
+        return False
+    
+    # Scanned PDFs sometimes carry a garbled (or glyph-id only) text layer
+    alnum_chars = sum(1 for c in visible_chars if c.isalnum())
+    if alnum_chars / len(visible_chars) < MIN_TEXT_LAYER_ALNUM_RATIO:
+        return False
+    
+    if image_coverage >= SCANNED_PAGE_IMAGE_COVERAGE:
+        return score_page_text(text) >= INVOICE_PAGE_THRESHOLD
+    return True
+
+
+def extract_pdf_text_layer(uploaded_file, page_number: int = 0) -> Optional[str]:
+    """
+    Read the embedded text layer of a PDF page with pypdf (no OCR).
+    Returns the page text, or None if the page has no usable text layer (e.g. scanned pages).
+    The file pointer is reset so the file can be processed again afterwards.
+    """
+    try:
+        from pypdf import PdfReader
+        
+        uploaded_file.seek(0)
+        pdf_reader = PdfReader(uploaded_file)
+        
+        if page_number < 0 or page_number >= len(pdf_reader.pages):
+            return None
+        
+        page = pdf_reader.pages[page_number]
+        plain_text, image_coverage = extract_page_text(page)
+        if not is_usable_text_layer(plain_text, image_coverage):
+            return None
+        
+        # Layout mode keeps columns aligned, which helps the model read tables
+        text = page.extract_text(extraction_mode="layout")
+    except Exception:
+        return None
+    finally:
+        try:
+            uploaded_file.seek(0)
+        except:
+            pass  # Some file objects don't support seek
+    
+    return text if text and text.strip() else None
+
+
+def process_pdf_upload(uploaded_file, page_number: int = 0, dpi: int = DEFAULT_PDF_DPI) -> Tuple[Optional[bytes], Optional[str], int]:
     """
     Process PDF file and convert specified page to image.
     Returns: (image_bytes, mime_type, total_pages)
@@ -169,37 +529,52 @@ def process_pdf_upload(uploaded_file, page_number: int = 0) -> Tuple[Optional[by
         except:
             pass  # Some file objects don't support seek
         
-        pdf_bytes = uploaded_file.read()
+        from pdf2image import convert_from_path
+        from pypdf import PdfReader
         
-        if not pdf_bytes or len(pdf_bytes) == 0:
-            raise ValueError("PDF file is empty or could not be read")
-        
-        # Get total number of pages
-        pdf_reader = PdfReader(BytesIO(pdf_bytes))
-        total_pages = len(pdf_reader.pages)
-        
-        if total_pages == 0:
-            raise ValueError("PDF has no pages")
-        
-        if page_number < 0 or page_number >= total_pages:
-            raise ValueError(f"Page number {page_number + 1} is out of range. PDF has {total_pages} page(s).")
-        
-        # Convert PDF page to image
-        images = convert_from_bytes(pdf_bytes, first_page=page_number + 1, last_page=page_number + 1, dpi=300)
-        
-        if not images or len(images) == 0:
-            raise ValueError(f"Failed to convert page {page_number + 1} to image.")
-        
-        # Convert PIL Image to RGB format and then to JPEG for better compatibility
-        img = images[0]
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Save as JPEG to ensure compatibility with Groq API
-        img_byte_arr = BytesIO()
-        img.save(img_byte_arr, format='JPEG', quality=95)
-        img_byte_arr.seek(0)
-        image_bytes = img_byte_arr.getvalue()
+        # Spool the upload to a temporary file so neither pypdf nor poppler needs the PDF in memory,
+        # and let poppler write the rendered page to disk instead of returning a PIL image
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pdf_path = os.path.join(temp_dir, "upload.pdf")
+            with open(pdf_path, "wb") as pdf_file:
+                shutil.copyfileobj(uploaded_file, pdf_file)
+            
+            if os.path.getsize(pdf_path) == 0:
+                raise ValueError("PDF file is empty or could not be read")
+            
+            # Get total number of pages (pypdf reads lazily from the open file, PdfReader(path) would load it all)
+            with open(pdf_path, "rb") as pdf_file:
+                pdf_reader = PdfReader(pdf_file)
+                total_pages = len(pdf_reader.pages)
+                
+                if total_pages == 0:
+                    raise ValueError("PDF has no pages")
+                
+                if page_number < 0 or page_number >= total_pages:
+                    raise ValueError(f"Page number {page_number + 1} is out of range. PDF has {total_pages} page(s).")
+                
+                # Reject oversized pages before rendering them
+                check_page_pixel_count(pdf_reader.pages[page_number], dpi, f"Page {page_number + 1}")
+            
+            # Convert PDF page straight to a JPEG file for compatibility with Groq API
+            with _rasterization_slots:
+                image_paths = convert_from_path(
+                    pdf_path,
+                    first_page=page_number + 1,
+                    last_page=page_number + 1,
+                    dpi=dpi,
+                    output_folder=temp_dir,
+                    fmt="jpeg",
+                    jpegopt={"quality": 95},
+                    paths_only=True,
+                    use_cropbox=True,
+                )
+            
+            if not image_paths or len(image_paths) == 0:
+                raise ValueError(f"Failed to convert page {page_number + 1} to image.")
+            
+            with open(image_paths[0], "rb") as image_file:
+                image_bytes = image_file.read()
         
         if not image_bytes or len(image_bytes) == 0:
             raise ValueError("Failed to convert image to bytes")
@@ -212,8 +587,19 @@ def process_image_upload(uploaded_file):
     if not uploaded_file:
         return None, None
     try:
+        from PIL import Image
+        
         image_bytes = uploaded_file.read()
         
+        # Reject oversized images before decoding them (opening only reads the header)
+        try:
+            with Image.open(BytesIO(image_bytes)) as probe_img:
+                image_size = probe_img.size
+        except Exception:
+            image_size = None
+        if image_size:
+            check_pixel_count(image_size[0], image_size[1], "Image")
+        
         # Validate that it's actually an image by trying to open it with PIL
         try:
             img = Image.open(BytesIO(image_bytes))
@@ -241,7 +627,7 @@ def process_image_upload(uploaded_file):
     except Exception as e:
         raise ValueError(f"Error processing image: {str(e)}")
 
-def process_file_upload(uploaded_file, page_number: int = 0) -> Tuple[Optional[bytes], Optional[str], Optional[int]]:
+def process_file_upload(uploaded_file, page_number: int = 0, dpi: int = DEFAULT_PDF_DPI) -> Tuple[Optional[bytes], Optional[str], Optional[int]]:
     """
     Process uploaded file (image or PDF) and return image bytes, mime type, and total pages (for PDFs).
     Returns: (image_bytes, mime_type, total_pages)
@@ -266,17 +652,56 @@ def process_file_upload(uploaded_file, page_number: int = 0) -> Tuple[Optional[b
         pass  # Some file objects don't support seek
     
     if file_extension == "pdf":
-        image_bytes, mime_type, total_pages = process_pdf_upload(uploaded_file, page_number)
+        image_bytes, mime_type, total_pages = process_pdf_upload(uploaded_file, page_number, dpi)
         return image_bytes, mime_type, total_pages
     else:
         image_bytes, mime_type = process_image_upload(uploaded_file)
         return image_bytes, mime_type, None
 
+def convert_to_jpeg(image_bytes: bytes, max_size: int = 4096) -> bytes:
+    """
+    Re-encode image bytes as JPEG for Groq API compatibility.
+    Transparent images are flattened onto white and images larger than max_size are downscaled.
+    """
+    from PIL import Image
+    
+    with Image.open(BytesIO(image_bytes)) as img:
+        img.load()  # Force load to ensure it's readable
+        if img.mode in ('RGBA', 'LA', 'P'):
+            rgba_img = img.convert('RGBA')
+            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
+            rgb_img.paste(rgba_img, mask=rgba_img.split()[3])
+        else:
+            rgb_img = img.convert('RGB')
+    
+    if rgb_img.width > max_size or rgb_img.height > max_size:
+        rgb_img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    
+    output = BytesIO()
+    rgb_img.save(output, format='JPEG', quality=90, optimize=True)
+    rgb_img.close()
+    return output.getvalue()
+
+def encode_image_content(image_bytes: bytes) -> dict:
+    """Encode JPEG bytes as a data URL image content item for the Groq API"""
+    if not image_bytes or len(image_bytes) < 100:
+        raise ValueError("Invalid image: File too small to be a valid image")
+    if image_bytes[:2] != b'\xff\xd8':
+        raise ValueError("Image is not a valid JPEG")
+    
+    base64_image = base64.b64encode(image_bytes).decode("utf-8")
+    return {
+        "type": "image_url",
+        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
+    }
+
 def process_image_url(image_url):
     if not image_url:
         return None
     try:
-        response = requests.get(image_url)
+        import requests
+        
+        response = requests.get(image_url, timeout=IMAGE_URL_TIMEOUT)
         response.raise_for_status()
         return response.content
     except Exception as e:
@@ -289,3 +714,244 @@ def display_image_preview(image_bytes):
         return base64_image
     except Exception as e:
         raise ValueError(f"Error processing image: {str(e)}")
+
+
+# ---------------------------
+# Invoice Page Detection
+# ---------------------------
+
+# Pages scoring at or above this are treated as likely invoice pages
+INVOICE_PAGE_THRESHOLD = 0.5
+# Resolution used for layout scoring of pages without a text layer
+PAGE_SCORING_DPI = 36
+# Most consecutive pages rendered per poppler call when scoring scanned PDFs
+PAGE_SCORING_BATCH = 20
+
+# Document titles that mark an invoice (multilingual)
+_INVOICE_TITLE_PATTERN = re.compile(
+    r"\b(invoice|tax invoice|facture|rechnung|factura|fattura|fatura|faktura|factuur|nota fiscal)\b"
+)
+# Fields typically present on an invoice page
+_INVOICE_FIELD_PATTERNS = [re.compile(pattern) for pattern in [
+    r"\b(invoice|inv)\.?\s*(no|number|#|date)",
+    r"\bbill(ed)?\s+to\b",
+    r"\bship(ped)?\s+to\b",
+    r"\bdue\s+date\b",
+    r"\bsub\s*-?\s*total\b",
+    r"\b(tax|vat|gst|tva|mwst|iva)\b",
+    r"\b(qty|quantity)\b",
+    r"\bunit\s+(price|cost)\b",
+    r"\b(amount|balance|total)\s+due\b",
+]]
+# Phrases typical of cover letters, terms and conditions and remittance slips
+_NON_INVOICE_PATTERNS = [re.compile(pattern) for pattern in [
+    r"\bterms\s+(and|&)\s+conditions\b",
+    r"\bgeneral\s+terms\b",
+    r"\bremittance\b",
+    r"\bdetach\s+and\s+return\b",
+    r"\bdear\s+\w+",
+    r"\b(sincerely|yours\s+faithfully|kind\s+regards|best\s+regards)\b",
+]]
+_AMOUNT_PATTERN = re.compile(r"\d{1,3}(?:[,.\s]\d{3})*[.,]\d{2}\b")
+
+
+def score_page_text(text: str) -> float:
+    """Likelihood (0-1) that a page is an invoice page, from keywords in its text layer"""
+    text = text.lower()
+    score = 0.0
+    
+    if _INVOICE_TITLE_PATTERN.search(text):
+        score += 0.35
+    score += min(0.4, 0.08 * sum(1 for pattern in _INVOICE_FIELD_PATTERNS if pattern.search(text)))
+    if len(_AMOUNT_PATTERN.findall(text)) >= 3:
+        score += 0.25
+    score -= 0.2 * sum(1 for pattern in _NON_INVOICE_PATTERNS if pattern.search(text))
+    
+    return round(min(max(score, 0.0), 1.0), 3)
+
+
+def score_page_layout(image) -> float:
+    """
+    Likelihood (0-1) that a page is an invoice page, from a low-resolution render.
+    Invoices have ruled tables and an amounts column on the right; letters and
+    terms pages are plain running text, and blank pages have no ink at all.
+    """
+    img = image.convert('L')
+    img.thumbnail((200, 300))
+    width, height = img.size
+    pixels = img.load()
+    
+    dark_rows = [[pixels[x, y] < 128 for x in range(width)] for y in range(height)]
+    ink = sum(sum(row) for row in dark_rows) / (width * height)
+    if ink < 0.005:
+        return 0.0
+    
+    row_ratios = [sum(row) / width for row in dark_rows]
+    text_rows = [y for y, ratio in enumerate(row_ratios) if ratio > 0.02]
+    text_coverage = len(text_rows) / height
+    
+    # Horizontal rules (table borders, separators): count runs of nearly fully dark rows
+    rule_lines = sum(
+        1 for y, ratio in enumerate(row_ratios)
+        if ratio > 0.5 and (y == 0 or row_ratios[y - 1] <= 0.5)
+    )
+    
+    # Amounts column: share of text rows with ink in the right quarter of the page
+    right_start = int(width * 0.75)
+    right_rows = sum(1 for y in text_rows if any(dark_rows[y][right_start:]))
+    right_share = right_rows / len(text_rows) if text_rows else 0.0
+    
+    score = 0.3
+    if rule_lines >= 2:
+        score += 0.3
+    if right_share >= 0.3:
+        score += 0.3
+    if text_coverage > 0.8:
+        score -= 0.3  # Dense running text, e.g. terms and conditions
+    elif text_coverage < 0.15:
+        score -= 0.2  # Very little content, e.g. a short cover letter or slip
+    
+    return round(min(max(score, 0.0), 1.0), 3)
+
+
+def _score_rendered_pages(pdf_path: str, temp_dir: str, page_numbers: List[int], page_scores: List[Dict]):
+    """Render consecutive pages at PAGE_SCORING_DPI into temp_dir and store their layout scores"""
+    from PIL import Image
+    from pdf2image import convert_from_path
+    
+    with _rasterization_slots:
+        image_paths = convert_from_path(
+            pdf_path, dpi=PAGE_SCORING_DPI, grayscale=True,
+            first_page=page_numbers[0] + 1, last_page=page_numbers[-1] + 1,
+            output_folder=temp_dir, fmt="jpeg", paths_only=True, use_cropbox=True
+        )
+    try:
+        if len(image_paths) != len(page_numbers):
+            raise ValueError(f"Expected {len(page_numbers)} rendered page(s), got {len(image_paths)}")
+        for page_number, image_path in zip(page_numbers, image_paths):
+            with Image.open(image_path) as image:
+                page_scores[page_number]['score'] = score_page_layout(image)
+    finally:
+        for image_path in image_paths:
+            os.remove(image_path)
+
+
+def score_pdf_pages(uploaded_file) -> List[Dict]:
+    """
+    Score every page of a PDF for how likely it is to be an invoice page, without any model calls.
+    Pages with a usable text layer are scored on keywords; other pages on the layout of a
+    low-DPI render; pages too large (see MAX_PAGE_PIXELS) or failing to render score 0.
+    Returns one {'page', 'score', 'source', 'likely_invoice'} dict per page.
+    """
+    from pypdf import PdfReader
+    
+    try:
+        uploaded_file.seek(0)
+    except:
+        pass  # Some file objects don't support seek
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = os.path.join(temp_dir, "upload.pdf")
+        with open(pdf_path, "wb") as pdf_file:
+            shutil.copyfileobj(uploaded_file, pdf_file)
+        
+        page_scores = []
+        pages_to_render = []
+        with open(pdf_path, "rb") as pdf_file:
+            pdf_reader = PdfReader(pdf_file)
+            for page_number, page in enumerate(pdf_reader.pages):
+                text, image_coverage = extract_page_text(page)
+                
+                if is_usable_text_layer(text, image_coverage):
+                    page_scores.append({'page': page_number, 'score': score_page_text(text), 'source': 'text_layer'})
+                    continue
+                
+                # Oversized pages are not rendered, even at scoring resolution
+                try:
+                    check_page_pixel_count(page, PAGE_SCORING_DPI, f"Page {page_number + 1}")
+                except ValueError:
+                    page_scores.append({'page': page_number, 'score': 0.0, 'source': 'skipped'})
+                    continue
+                
+                page_scores.append({'page': page_number, 'score': 0.0, 'source': 'layout'})
+                pages_to_render.append(page_number)
+        
+        # Render runs of consecutive pages without a text layer in one poppler call each,
+        # straight to disk, then score and delete the files one page at a time
+        batches = []
+        for page_number in pages_to_render:
+            if batches and batches[-1][-1] == page_number - 1 and len(batches[-1]) < PAGE_SCORING_BATCH:
+                batches[-1].append(page_number)
+            else:
+                batches.append([page_number])
+        
+        for batch in batches:
+            try:
+                _score_rendered_pages(pdf_path, temp_dir, batch, page_scores)
+            except Exception:
+                # Retry page by page so one unreadable page doesn't lose the scores of its neighbours
+                for page_number in batch:
+                    try:
+                        _score_rendered_pages(pdf_path, temp_dir, [page_number], page_scores)
+                    except Exception:
+                        page_scores[page_number]['score'] = 0.0
+                        page_scores[page_number]['source'] = 'skipped'
+    
+    try:
+        uploaded_file.seek(0)
+    except:
+        pass
+    
+    for page_score in page_scores:
+        page_score['likely_invoice'] = page_score['score'] >= INVOICE_PAGE_THRESHOLD
+    return page_scores
+
+
+def select_invoice_page(page_scores: List[Dict]) -> Optional[int]:
+    """Highest-scoring likely invoice page, or None if no page looks like an invoice"""
+    likely_pages = [page_score for page_score in page_scores if page_score['likely_invoice']]
+    if not likely_pages:
+        return None
+    return max(likely_pages, key=lambda page_score: page_score['score'])['page']
+
+
+# ---------------------------
+# Upload Preparation
+# ---------------------------
+
+def prepare_upload(uploaded_file, page_number, text_layer_mode: str = 'auto') -> Tuple[int, Optional[str], Optional[dict]]:
+    """
+    Blocking part of an upload extraction, shared by the Flask and async servers: page detection,
+    text layer detection, rasterization and encoding.
+    page_number may be 'auto' to pick the most likely invoice page of a PDF.
+    Returns: (page_number, text_layer, image_content); image_content is None for text-only extraction.
+    Raises ValueError (or the underlying processing error) if the upload can't be used.
+    """
+    is_pdf = uploaded_file.filename.lower().endswith('.pdf')
+    if page_number == 'auto':
+        # Skip cover letters, terms and remittance slips so no model calls are spent on them
+        page_number = select_invoice_page(score_pdf_pages(uploaded_file)) if is_pdf else 0
+        if page_number is None:
+            raise ValueError("No invoice page detected in PDF")
+    
+    # Use the PDF's embedded text layer instead of OCR when it has one
+    text_layer = None
+    if is_pdf and text_layer_mode != 'off':
+        text_layer = extract_pdf_text_layer(uploaded_file, page_number)
+    
+    if text_layer is not None and text_layer_mode == 'text_only':
+        return page_number, text_layer, None
+    
+    uploaded_file.seek(0)
+    dpi = TEXT_LAYER_PDF_DPI if text_layer is not None else DEFAULT_PDF_DPI
+    image_bytes, mime_type, total_pages = process_file_upload(uploaded_file, page_number, dpi)
+    if not image_bytes:
+        raise ValueError("No image data generated")
+    if len(image_bytes) < 100:
+        raise ValueError("Invalid image: File too small to be a valid image")
+    
+    # PDF pages and decodable images are already JPEG; anything else is re-encoded
+    if image_bytes[:2] != b'\xff\xd8':
+        image_bytes = convert_to_jpeg(image_bytes)
+    
+    return page_number, text_layer, encode_image_content(image_bytes)
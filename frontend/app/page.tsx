@@ -293,7 +293,8 @@ export default function Home() {
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify(sanitizedData),
+        // Raw OCR text is not stored in Excel but is added to the search index
+        body: JSON.stringify({ ...sanitizedData, raw_ocr_text: rawOcrText }),
       });
 
       const data = await response.json();